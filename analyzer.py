@@ -0,0 +1,356 @@
+# Offline analyzer of replays saved by tetris.py
+# For every move finds the best placement of the block (with next block lookahead)
+# and reports how far the player's placement was from it.
+#
+# Usage: python analyzer.py replays/*.json [--moves] [--json report.json] [--processes N]
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import sys
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#                                                 CONSTANT DECLARATION                                                 #
+# -------------------------------------------------------------------------------------------------------------------- #
+# Same shapes as Block.set_shape in tetris.py, which can not be imported without opening a window
+SHAPES = [
+    [[0, 1, 0, 0],
+     [0, 1, 0, 0],
+     [0, 1, 0, 0],
+     [0, 1, 0, 0]],
+    [[1, 0, 0],
+     [1, 0, 0],
+     [1, 1, 0]],
+    [[0, 0, 1],
+     [0, 0, 1],
+     [0, 1, 1]],
+    [[0, 1, 1],
+     [1, 1, 0],
+     [0, 0, 0]],
+    [[1, 1, 0],
+     [0, 1, 1],
+     [0, 0, 0]],
+    [[1, 1, 1],
+     [0, 1, 0],
+     [0, 0, 0]],
+    [[1, 1],
+     [1, 1]],
+]
+
+# Weights of board evaluation
+WEIGHT_HEIGHT = -0.510066
+WEIGHT_LINES = 0.760666
+WEIGHT_HOLES = -0.35663
+WEIGHT_BUMPINESS = -0.184483
+
+LOST_VALUE = -1000.0  # Value of a board where the next block can not be placed
+EPSILON = 1e-9
+
+WORST_MOVES = 5  # Number of worst moves printed in the game summary
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#                                                 BOARD FUNCTIONS                                                      #
+# -------------------------------------------------------------------------------------------------------------------- #
+# Board is a tuple of columns, each column is an int with bit r set when row r (from the bottom) is filled.
+# Piece is a tuple of (mask, bottom, top) for each of its columns, rows are relative to the lowest cell.
+
+def turn_over(shape):
+    # Rotation 90 deg clockwise, the same as Block.turn_over
+    tmp = [[0] * len(shape[0]) for _ in range(len(shape))]
+    for row in range(len(shape)):
+        for col in range(len(shape[0])):
+            if shape[row][col] == 1:
+                tmp[col][len(shape) - 1 - row] = 1
+    return tmp
+
+
+def shape_cells(shape, x, y):
+    cells = []
+    for row in range(len(shape)):
+        for col in range(len(shape[row])):
+            # We start from bottom-left corner of the shape
+            if shape[len(shape) - 1 - row][col] == 1:
+                cells.append((x + col, y + row))
+    return cells
+
+
+def piece_from_cells(cells):
+    min_x = min(x for x, _ in cells)
+    min_y = min(y for _, y in cells)
+    piece = []
+    for col in range(max(x for x, _ in cells) - min_x + 1):
+        rows = [y - min_y for x, y in cells if x - min_x == col]
+        mask = 0
+        for row in rows:
+            mask |= 1 << row
+        piece.append((mask, min(rows), max(rows)))
+    return tuple(piece)
+
+
+@functools.lru_cache(maxsize=None)
+def rotations(shape_type):
+    pieces = []
+    shape = SHAPES[shape_type]
+    for _ in range(4):
+        piece = piece_from_cells(shape_cells(shape, 0, 0))
+        if piece not in pieces:
+            pieces.append(piece)
+        shape = turn_over(shape)
+    return tuple(pieces)
+
+
+def board_from_grid(data):
+    board = [0] * len(data[0])
+    for row in range(len(data)):
+        for col in range(len(data[row])):
+            if data[row][col] is not None:
+                board[col] |= 1 << row
+    return tuple(board)
+
+
+def clear_rows(board, height):
+    full = (1 << height) - 1
+    for column in board:
+        full &= column
+    if not full:
+        return board, 0
+
+    board = list(board)
+    lines = 0
+    # Removes rows from the top, so lower row indexes stay valid
+    for row in range(height - 1, -1, -1):
+        if full >> row & 1:
+            lines += 1
+            low = (1 << row) - 1
+            for col in range(len(board)):
+                board[col] = (board[col] >> (row + 1) << row) | (board[col] & low)
+    return tuple(board), lines
+
+
+def drop(board, piece, x, height):
+    """
+    Drops the piece straight down from the top of the grid at column x.
+    Returns (board, cleared lines) or None when the piece does not fit.
+    """
+    y = 0
+    for col, (mask, bottom, top) in enumerate(piece):
+        y = max(y, board[x + col].bit_length() - bottom)
+
+    board = list(board)
+    for col, (mask, bottom, top) in enumerate(piece):
+        if y + top >= height:
+            return None
+        board[x + col] |= mask << y
+    return clear_rows(tuple(board), height)
+
+
+def place(board, cells, height):
+    # Places cells exactly where the player put them
+    board = list(board)
+    for x, y in cells:
+        if x < 0 or x >= len(board) or y < 0 or y >= height or board[x] >> y & 1:
+            raise ValueError('placement (%d, %d) is not free' % (x, y))
+        board[x] |= 1 << y
+    return clear_rows(tuple(board), height)
+
+
+def placements(board, shape_type, height):
+    for rotation, piece in enumerate(rotations(shape_type)):
+        for x in range(len(board) - len(piece) + 1):
+            result = drop(board, piece, x, height)
+            if result is not None:
+                yield rotation, x, result[0], result[1]
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#                                                 EVALUATION                                                           #
+# -------------------------------------------------------------------------------------------------------------------- #
+def evaluate(board):
+    heights = [column.bit_length() for column in board]
+    holes = 0
+    for column, h in zip(board, heights):
+        holes += h - bin(column).count('1')
+    bumpiness = 0
+    for col in range(len(heights) - 1):
+        bumpiness += abs(heights[col] - heights[col + 1])
+    return WEIGHT_HEIGHT * sum(heights) + WEIGHT_HOLES * holes + WEIGHT_BUMPINESS * bumpiness
+
+
+# Cache lives in each worker process. The player's board is usually one of the searched placements,
+# so its lookahead is computed only once.
+@functools.lru_cache(maxsize=1 << 12)
+def best_next(board, next_type, height):
+    if next_type is None:
+        return evaluate(board)
+
+    best = LOST_VALUE
+    for rotation, x, next_board, lines in placements(board, next_type, height):
+        best = max(best, WEIGHT_LINES * lines + evaluate(next_board))
+    return best
+
+
+def move_value(board, lines, next_type, height):
+    return WEIGHT_LINES * lines + best_next(board, next_type, height)
+
+
+def analyze_move(task):
+    index, board, height, shape_type, next_type, cells = task
+
+    player_board, player_lines = place(board, cells, height)
+    player_value = move_value(player_board, player_lines, next_type, height)
+
+    best_value = LOST_VALUE
+    best_board = None
+    best_placement = None
+    better = 0
+    count = 0
+    for rotation, x, new_board, lines in placements(board, shape_type, height):
+        value = move_value(new_board, lines, next_type, height)
+        count += 1
+        if value > player_value + EPSILON:
+            better += 1
+        if best_board is None or value > best_value:
+            best_value = value
+            best_board = new_board
+            best_placement = (rotation, x)  # Rotation index is the number of turns
+
+    # Player could have reached the board in a way the straight drop does not (sliding under overhang)
+    if player_value > best_value:
+        best_value = player_value
+        best_board = player_board
+        best_placement = None
+    return {
+        'move': index,
+        'type': shape_type,
+        'player_value': player_value,
+        'best_value': best_value,
+        'loss': best_value - player_value,
+        'rank': better + 1,
+        'placements': count,
+        'best_turns': best_placement[0] if best_placement else None,
+        'best_column': best_placement[1] if best_placement else None,
+        'accurate': best_board == player_board or best_value - player_value <= EPSILON,
+    }
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#                                                 REPLAY FUNCTIONS                                                     #
+# -------------------------------------------------------------------------------------------------------------------- #
+def load_replay(file_name):
+    file = open(file_name, "r")
+    data = json.load(file)
+    file.close()
+    return data
+
+
+def check_type(shape_type):
+    if not isinstance(shape_type, int) or isinstance(shape_type, bool) or not 0 <= shape_type < len(SHAPES):
+        raise ValueError('unknown block type %r' % (shape_type,))
+
+
+def replay_tasks(replay):
+    # Boards have to be rebuilt sequentially, the search itself is then independent for each move
+    height = replay['height']
+    board = board_from_grid(replay['grid'])
+    tasks = []
+    for index, placement in enumerate(replay['placements']):
+        check_type(placement['type'])
+        if placement.get('next_type') is not None:
+            check_type(placement['next_type'])
+        cells = shape_cells(placement['shape'], placement['x'], placement['y'])
+        tasks.append((index, board, height, placement['type'], placement.get('next_type'), cells))
+        board = place(board, cells, height)[0]
+    return tasks
+
+
+def game_summary(file_name, moves):
+    losses = [move['loss'] for move in moves]
+    return {
+        'file': file_name,
+        'moves': len(moves),
+        'accuracy': sum(move['accurate'] for move in moves) / len(moves) if moves else 0.0,
+        'mean_loss': sum(losses) / len(losses) if losses else 0.0,
+        'max_loss': max(losses) if losses else 0.0,
+        'mean_rank': sum(move['rank'] for move in moves) / len(moves) if moves else 0.0,
+        'worst_moves': sorted(moves, key=lambda move: move['loss'], reverse=True)[:WORST_MOVES],
+    }
+
+
+def analyze_replays(file_names, processes=None):
+    """
+    Returns (reports, skipped), where skipped is a list of (file name, error) for broken replays.
+    """
+    tasks = []
+    games = []
+    skipped = []
+    for file_name in file_names:
+        # One broken replay must not stop the whole batch
+        try:
+            game_tasks = replay_tasks(load_replay(file_name))
+        except (ValueError, OSError, KeyError, IndexError, TypeError) as error:
+            skipped.append((file_name, str(error)))
+            continue
+        games.append((file_name, len(game_tasks)))
+        tasks += game_tasks
+
+    processes = processes or os.cpu_count() or 1
+    pool = multiprocessing.Pool(processes)
+    chunk_size = max(1, len(tasks) // (4 * processes))
+    moves = pool.map(analyze_move, tasks, chunk_size)
+    pool.close()
+    pool.join()
+
+    reports = []
+    start = 0
+    for file_name, count in games:
+        game_moves = moves[start:start + count]
+        start += count
+        reports.append({'summary': game_summary(file_name, game_moves), 'moves': game_moves})
+    return reports, skipped
+
+
+def print_report(report, print_moves):
+    summary = report['summary']
+    print(summary['file'])
+    print('  moves: %d, accuracy: %.1f %%, mean loss: %.3f, max loss: %.3f, mean rank: %.2f'
+          % (summary['moves'], 100 * summary['accuracy'], summary['mean_loss'], summary['max_loss'],
+             summary['mean_rank']))
+
+    moves = report['moves'] if print_moves else summary['worst_moves']
+    for move in moves:
+        if move['best_turns'] is None:
+            best = 'best is the player\'s own placement'
+        else:
+            best = 'best is %d turns at column %d' % (move['best_turns'], move['best_column'])
+        print('  move %4d: loss %.3f, rank %d/%d, %s'
+              % (move['move'], move['loss'], move['rank'], move['placements'], best))
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#                                                 MAIN FUNCTION                                                        #
+# -------------------------------------------------------------------------------------------------------------------- #
+def main():
+    parser = argparse.ArgumentParser(description='Compares player\'s placements with the best ones.')
+    parser.add_argument('replays', nargs='+', help='replay files saved by the game')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--moves', action='store_true', help='print every move, not only the worst ones')
+    parser.add_argument('--json', help='write full report to this file')
+    args = parser.parse_args()
+
+    reports, skipped = analyze_replays(args.replays, args.processes)
+    for report in reports:
+        print_report(report, args.moves)
+    for file_name, error in skipped:
+        print('%s skipped: %s' % (file_name, error), file=sys.stderr)
+
+    if args.json:
+        file = open(args.json, "w")
+        json.dump({'reports': reports, 'skipped': [{'file': f, 'error': e} for f, e in skipped]}, file, indent=4)
+        file.close()
+
+
+if __name__ == '__main__':
+    main()
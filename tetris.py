@@ -3,6 +3,12 @@
 
 import random
 import json
+import os
+import sys
+import threading
+import time
+import http.server
+from array import array
 import pyglet
 
 from pyglet.window import key
@@ -31,6 +37,13 @@ SCORE_Y = WINDOW_OFFSET + ((PLAY_GRID_HEIGHT * (TILE_SIZE + 1) + 1) * 3) // 4
 
 GAME_SPEED = 2.0  # Starting game speed
 
+REPLAY_DIR = "replays"  # Finished games are saved here for analyzer.py
+
+METRICS_FILE = "metrics.prom"  # Prometheus text-format file, None disables it
+METRICS_HTTP_PORT = None  # Port of localhost /metrics endpoint, None disables it
+METRICS_FLUSH_INTERVAL = 15.0  # Seconds between two flushes
+METRICS_FRAME_SAMPLES = 1024  # Number of last frame times used for percentiles
+
 
 # -------------------------------------------------------------------------------------------------------------------- #
 #                                                 OVERLAY CLASSES                                                      #
@@ -362,6 +375,7 @@ class Grid:
             if self.data[index].count(None) == 0:
                 # Index has to be the same in the next iteration, because all rows dropped by 1
                 score += 1
+                metrics.lines_cleared += 1
                 game.speed_up()
 
                 del self.data[index]
@@ -405,6 +419,8 @@ class Game:
         self.next_block = Block(self.grid.start_x, self.grid.start_y)
         self.speed = GAME_SPEED
         self.fell = False
+        self.replay_grid = []
+        self.replay = []
 
     def update(self, dt):
         if not self.block.move_down(self.grid):
@@ -413,6 +429,8 @@ class Game:
             if not self.grid.is_free(self.block.shape, self.block.x, self.block.y):
                 # losing game, new block can not be spawned
                 pyglet.clock.unschedule(self.update)
+                metrics.game_over(self.speed)
+                self.save_replay()
                 set_overlay(Banner("Game over!", self.reset))
                 update_leaderboard()
 
@@ -454,6 +472,8 @@ class Game:
         self.next_block = Block(self.grid.start_x, self.grid.start_y)
 
         score = 0
+        self.start_replay()
+        metrics.games_started += 1
         self.unpause()
 
     def speed_up(self):
@@ -463,6 +483,13 @@ class Game:
             pyglet.clock.schedule_interval(self.update, 1 / self.speed)
 
     def block_fell(self):
+        self.replay.append({
+            'type': self.block.type,
+            'next_type': self.next_block.type,
+            'shape': self.block.shape,
+            'x': self.block.x,
+            'y': self.block.y,
+        })
         self.grid.add_block(self.block)
         self.grid.check_rows()
 
@@ -471,6 +498,7 @@ class Game:
         self.next_block = Block(self.grid.start_x, self.grid.start_y)
 
     def load(self):
+        start = time.perf_counter()
         try:
             file = open("save.json", "r")
         except (FileNotFoundError, IOError):
@@ -478,14 +506,46 @@ class Game:
         data = json.load(file)
         self.set_from_JSON(data)
         file.close()
+        metrics.loaded(time.perf_counter() - start)
         unpause_game()
 
     def save(self):
+        start = time.perf_counter()
         file = open("save.json", "w")
         json.dump(self.toJSON(), file, indent=4)
         file.close()
+        metrics.saved(time.perf_counter() - start)
         set_overlay(Banner("Saved", self.unpause))
 
+    def start_replay(self):
+        # Replay starts from the current grid, which does not have to be empty after loading
+        self.replay_grid = [row[:] for row in self.grid.data]
+        self.replay = []
+
+    def save_replay(self):
+        # Suffix keeps games ended in the same second apart
+        name = os.path.join(REPLAY_DIR, time.strftime("%Y%m%d-%H%M%S"))
+        file_name = name + ".json"
+        suffix = 1
+        while os.path.exists(file_name):
+            file_name = name + "-" + str(suffix) + ".json"
+            suffix += 1
+
+        # Writes to temporary file first, so analyzer never reads half written replay
+        try:
+            os.makedirs(REPLAY_DIR, exist_ok=True)
+            file = open(file_name + '.tmp', "w")
+            json.dump({
+                'width': self.grid.width,
+                'height': self.grid.height,
+                'grid': self.replay_grid,
+                'placements': self.replay,
+            }, file)
+            file.close()
+            os.replace(file_name + '.tmp', file_name)
+        except (FileNotFoundError, IOError):
+            return
+
     def toJSON(self):
         return {
             'grid': self.grid.toJSON(),
@@ -502,6 +562,209 @@ class Game:
         self.next_block.set_from_JSON(data['next_block'])
         self.speed = data['speed']
         score = data['score']
+        self.start_replay()
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#                                                 METRICS CLASS                                                        #
+# -------------------------------------------------------------------------------------------------------------------- #
+class Metrics:
+    """
+    Counts operational metrics and periodically exports them in Prometheus text format.
+    Counters are written only by the main thread and read by the flush thread, so no lock is needed.
+    Frame times go to preallocated ring buffer, percentiles are computed at flush time.
+    """
+    def __init__(self, file_name, http_port, flush_interval, frame_samples):
+        self.file_name = file_name
+        self.http_port = http_port
+        self.flush_interval = flush_interval
+
+        self.start_time = time.time()
+        self.games_started = 0
+        self.game_overs = 0
+        self.lines_cleared = 0
+        self.speed_sum = 0.0
+        self.saves = 0
+        self.save_seconds = 0.0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.crashes = 0
+
+        self.frame_times = array('d', bytes(8 * frame_samples))  # Zero filled, never resized
+        self.frame_index = 0
+        self.frame_count = 0
+        self.frame_seconds = 0.0
+
+        self.text = ''
+        self.flush_lock = threading.Lock()  # Flush thread and excepthook write the same file
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        self.crashes = self.load_crashes()
+        # First flush makes the file and endpoint available right away
+        self.flush()
+        self.thread = threading.Thread(target=self.run, name='metrics-flush', daemon=True)
+        self.thread.start()
+
+        if self.http_port is not None:
+            try:
+                self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.http_port), MetricsHandler)
+            except OSError as error:
+                # Metrics must never stop the game, endpoint is just disabled
+                print('Metrics endpoint disabled: %s' % error, file=sys.stderr)
+                return
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.server:
+            self.server.shutdown()
+        self.flush()
+
+    def load_crashes(self):
+        # Crashed process can not report itself, so the count is carried over from the last written file
+        if self.file_name is None:
+            return 0
+        try:
+            file = open(self.file_name, "r")
+        except (FileNotFoundError, IOError):
+            return 0
+
+        crashes = 0
+        for line in file:
+            if line.startswith('tetris_crashes_total '):
+                try:
+                    crashes = int(line.split()[1])
+                except ValueError:
+                    pass
+        file.close()
+        return crashes
+
+    def run(self):
+        # Event.wait returns True only after stop() was called
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def frame(self, frame_time):
+        # Called every frame, only stores the value to the preallocated buffer
+        self.frame_times[self.frame_index] = frame_time
+        self.frame_index += 1
+        if self.frame_index == len(self.frame_times):
+            self.frame_index = 0
+        # Sum before count, flush thread reads them without lock
+        self.frame_seconds += frame_time
+        self.frame_count += 1
+
+    def game_over(self, speed):
+        # Sum before count, flush thread reads them without lock
+        self.speed_sum += speed
+        self.game_overs += 1
+
+    def saved(self, duration):
+        # Sum before count, flush thread reads them without lock
+        self.save_seconds += duration
+        self.saves += 1
+
+    def loaded(self, duration):
+        # Sum before count, flush thread reads them without lock
+        self.load_seconds += duration
+        self.loads += 1
+
+    def frame_percentiles(self):
+        # Copy is taken at once, main thread may keep writing to the buffer meanwhile
+        samples = sorted(self.frame_times[:min(self.frame_count, len(self.frame_times))])
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in (0.5, 0.9, 0.99)}
+
+    def render(self):
+        # Counts are read before sums, so every counted value is already in its sum
+        game_overs = self.game_overs
+        saves = self.saves
+        loads = self.loads
+        frame_count = self.frame_count
+        lines = [
+            '# HELP tetris_start_time_seconds Unix time when the game was started.',
+            '# TYPE tetris_start_time_seconds gauge',
+            'tetris_start_time_seconds %f' % self.start_time,
+            '# HELP tetris_games_started_total Number of started games.',
+            '# TYPE tetris_games_started_total counter',
+            'tetris_games_started_total %d' % self.games_started,
+            '# HELP tetris_game_overs_total Number of lost games.',
+            '# TYPE tetris_game_overs_total counter',
+            'tetris_game_overs_total %d' % game_overs,
+            '# HELP tetris_lines_cleared_total Number of cleared lines.',
+            '# TYPE tetris_lines_cleared_total counter',
+            'tetris_lines_cleared_total %d' % self.lines_cleared,
+            '# HELP tetris_speed_reached Game speed reached at game over.',
+            '# TYPE tetris_speed_reached summary',
+            'tetris_speed_reached_sum %f' % self.speed_sum,
+            'tetris_speed_reached_count %d' % game_overs,
+            '# HELP tetris_save_seconds Duration of game saves.',
+            '# TYPE tetris_save_seconds summary',
+            'tetris_save_seconds_sum %f' % self.save_seconds,
+            'tetris_save_seconds_count %d' % saves,
+            '# HELP tetris_load_seconds Duration of game loads.',
+            '# TYPE tetris_load_seconds summary',
+            'tetris_load_seconds_sum %f' % self.load_seconds,
+            'tetris_load_seconds_count %d' % loads,
+            '# HELP tetris_frame_seconds Duration of frame drawing, quantiles over the last %d frames.'
+            % len(self.frame_times),
+            '# TYPE tetris_frame_seconds summary',
+        ]
+        for q, value in self.frame_percentiles().items():
+            lines.append('tetris_frame_seconds{quantile="%s"} %f' % (q, value))
+        lines += [
+            'tetris_frame_seconds_sum %f' % self.frame_seconds,
+            'tetris_frame_seconds_count %d' % frame_count,
+            '# HELP tetris_crashes_total Number of unhandled exceptions, kept across restarts in the metrics file.',
+            '# TYPE tetris_crashes_total counter',
+            'tetris_crashes_total %d' % self.crashes,
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        with self.flush_lock:
+            self.text = self.render()
+            if self.file_name is None:
+                return
+
+            # Writes to temporary file first, so scraper never reads half written file
+            try:
+                file = open(self.file_name + '.tmp', "w")
+                file.write(self.text)
+                file.close()
+                os.replace(self.file_name + '.tmp', self.file_name)
+            except (FileNotFoundError, IOError):
+                return
+
+    def excepthook(self, exc_type, exc_value, exc_traceback):
+        # Ctrl+C is the operator quitting, not a crash
+        if not issubclass(exc_type, KeyboardInterrupt):
+            self.crashes += 1
+            self.flush()
+        sys.__excepthook__(exc_type, exc_value, exc_traceback)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 # -------------------------------------------------------------------------------------------------------------------- #
@@ -514,7 +777,10 @@ def main():
     window_y = (pyglet.canvas.Display().get_screens()[0].height - WINDOW_HEIGHT) // 2
     window.set_location(window_x, window_y)
 
+    sys.excepthook = metrics.excepthook
+    metrics.start()
     pyglet.app.run()
+    metrics.stop()
 
 
 # -------------------------------------------------------------------------------------------------------------------- #
@@ -618,6 +884,7 @@ next_block_label = pyglet.text.Label("Next block:", FONT_NAME, FONT_SIZE_SCORE,
                                      color=(0, 255, 120, 255))
 overlay = main_menu
 score = 0
+metrics = Metrics(METRICS_FILE, METRICS_HTTP_PORT, METRICS_FLUSH_INTERVAL, METRICS_FRAME_SAMPLES)
 game = Game()
 can_use_mouse = False
 
@@ -627,6 +894,7 @@ can_use_mouse = False
 # -------------------------------------------------------------------------------------------------------------------- #
 @window.event
 def on_draw():
+    frame_start = time.perf_counter()
     window.clear()
     background.blit(0, 0)
 
@@ -639,6 +907,8 @@ def on_draw():
     if overlay:
         overlay.draw()
 
+    metrics.frame(time.perf_counter() - frame_start)
+
 
 @window.event
 def on_key_press(symbol, modifiers):